@@ -3,144 +3,505 @@
 
 import argparse
 import asyncio
-import io
+import codecs
+import logging
+import os
+import stat
 import sys
-import traceback
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
-import telepot.aio
+try:
+    import uvloop
+except ImportError:
+    pass
+else:
+    # telepot.aio binds its HTTP session to the event loop that is current
+    # when it's imported, so uvloop has to be in place before that.
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.set_event_loop(asyncio.new_event_loop())
 
+import telepot.aio  # pylint: disable=wrong-import-position
+import telepot.exception  # pylint: disable=wrong-import-position
 
-def media_wrapper(func):
-    async def wrapper(bot, chat_id, media, *args, **kwargs):
-        with io.BytesIO(media) as stream:
-            return await func(bot, chat_id, stream, *args, **kwargs)
-    return wrapper
 
+logger = logging.getLogger("botcat")
 
+
+# Maximum length of a Telegram text message
+MAX_MESSAGE_LENGTH = 4096
+
+# How many input lines may wait to be sent before we stop reading. That's
+# enough to fill a message even when the lines are empty.
+MAX_QUEUED_LINES = MAX_MESSAGE_LENGTH
+
+# Upper bound, in seconds, of the delay between consecutive retries
+MAX_RETRY_DELAY = 30
+
+# Event loop time before which no message should be sent, following a
+# "Too Many Requests" response. Shared by all senders.
+_resume_sending_at = 0.0
+
+
+# telepot hands media to aiohttp's FormData, which takes bytes as they are,
+# so there's no need to copy them into a file-like object first.
 MESSAGE_TYPES = {
     "text": telepot.aio.Bot.sendMessage,
-    "photo": media_wrapper(telepot.aio.Bot.sendPhoto),
-    "audio": media_wrapper(telepot.aio.Bot.sendAudio),
-    "document": media_wrapper(telepot.aio.Bot.sendDocument),
-    "video": media_wrapper(telepot.aio.Bot.sendVideo),
-    "voice": media_wrapper(telepot.aio.Bot.sendVoice)
+    "photo": telepot.aio.Bot.sendPhoto,
+    "audio": telepot.aio.Bot.sendAudio,
+    "document": telepot.aio.Bot.sendDocument,
+    "video": telepot.aio.Bot.sendVideo,
+    "voice": telepot.aio.Bot.sendVoice
 }
 
+# Message types that may be too large to comfortably buffer in memory
+STREAMED_TYPES = ("document", "video")
+
+
+def strip_line_ending(line):
+    # Both LF and CRLF terminated input should give the same messages
+    if line.endswith("\n"):
+        line = line[:-1]
+    if line.endswith("\r"):
+        line = line[:-1]
+    return line
+
 
 class Reader:
     def __init__(self, loop, stream):
         self._loop = loop
         self._stream = stream
-        self._executor = ThreadPoolExecutor()
+        # stdin is a single serial stream, so one worker thread is all we
+        # need. It's kept to ourselves, so a blocked read can't hold up
+        # anything else the loop runs in an executor.
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="stdin")
 
     def __aiter__(self):
         return self
 
     async def __anext__(self):
         line = await self.readline()
-        if line == "":
+        if not line:
             raise StopAsyncIteration
-        return line
+        return strip_line_ending(line.decode("utf-8", errors="replace"))
 
     async def readline(self):
         return await self._loop.run_in_executor(self._executor,
-                                                self._stream.readline)
+                                                self._stream.buffer.readline)
 
-    async def read(self):
-        return await self._loop.run_in_executor(self._executor,
-                                                self._stream.read)
+    def close(self):
+        # Don't wait for a read that may never return
+        self._executor.shutdown(wait=False)
+
+
+class NonBlockingReader:
+    """
+    Reads lines straight off the stream's file descriptor from the event loop,
+    without a round-trip through a worker thread for every line.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, loop, stream):
+        self._loop = loop
+        self._fd = stream.fileno()
+        # Decode the same way as the rest of the input
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._partial = ""
+        self._lines = asyncio.Queue()
+        self._paused = False
+        self._blocking = os.get_blocking(self._fd)
+
+        # Only touch the descriptor once we know the loop can watch it
+        self._loop.add_reader(self._fd, self._on_readable)
+        os.set_blocking(self._fd, False)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        line = await self._lines.get()
+
+        # Pick up reading again once the backlog is gone
+        if self._paused and self._lines.empty():
+            self._paused = False
+            self._loop.add_reader(self._fd, self._on_readable)
+
+        if line is None:
+            raise StopAsyncIteration
+        if isinstance(line, Exception):
+            raise line
+        return line
+
+    def close(self):
+        self._paused = False
+        self._loop.remove_reader(self._fd)
+        # The descriptor is shared with whoever started us, so put it back
+        # the way we found it.
+        os.set_blocking(self._fd, self._blocking)
+
+    def _on_readable(self):
+        try:
+            self._read_lines()
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            # Hand the error over to whoever is iterating, and stop reading
+            self._loop.remove_reader(self._fd)
+            self._lines.put_nowait(e)
+
+    def _read_lines(self):
+        data = os.read(self._fd, self.CHUNK_SIZE)
+
+        if not data:
+            self._loop.remove_reader(self._fd)
+            text = self._partial + self._decoder.decode(b"", final=True)
+            if text:
+                self._lines.put_nowait(strip_line_ending(text))
+            self._lines.put_nowait(None)
+            return
+
+        lines = (self._partial + self._decoder.decode(data)).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._lines.put_nowait(strip_line_ending(line))
+
+        # Stop reading while the consumer catches up, so that we don't end up
+        # holding all of the input in memory
+        if self._lines.qsize() >= MAX_QUEUED_LINES:
+            self._paused = True
+            self._loop.remove_reader(self._fd)
+
+
+def open_line_reader(loop, stream):
+    # Only pipes and sockets can be polled reliably; regular files and
+    # devices such as /dev/null are refused by epoll, and nothing can be
+    # polled on Windows.
+    if sys.platform != "win32":
+        mode = os.fstat(stream.fileno()).st_mode
+        if stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+            try:
+                return NonBlockingReader(loop, stream)
+            except OSError:
+                pass
+    return Reader(loop, stream)
+
+
+def _check_negative(argument):
+    value = int(argument)
+    if value < 0:
+        raise argparse.ArgumentTypeError("'%s' is not a positive integer"
+                                         % (argument,))
+    return value
+
+
+def _check_positive(argument):
+    value = int(argument)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("'%s' is not a positive integer"
+                                         % (argument,))
+    return value
+
+
+# Built once at import time, so that only the parsing itself is left for
+# parse_command_line
+_PARSER = argparse.ArgumentParser(description="Redirects stdin to a "
+                                              "Telegram channel or chat.")
+_PARSER.add_argument("token", help="API token of the Telegram bot.")
+_PARSER.add_argument("channel", help="Chat ID or channel for broadcasts.")
+_PARSER.add_argument("--type", help="Type of message to send. " +
+                                    "(Defaults to %(default)s.)",
+                     choices=MESSAGE_TYPES.keys(),
+                     default="text")
+_PARSER.add_argument("-m", "--parse-mode", help="How the input should be "
+                                                "parsed. With "
+                                                "--split-newlines, each line "
+                                                "is then sent as is, without "
+                                                "being combined with others.",
+                     choices=("HTML", "Markdown"))
+_PARSER.add_argument("-s", "--split-newlines", help="If specified, each "
+                                                    "input line will be "
+                                                    "sent as an individual "
+                                                    "message.",
+                     action="store_true")
+_PARSER.add_argument("-r", "--retries", help="How many times a failed send "
+                                             "should be retried. Specify "
+                                             "0 to retry indefinitely. "
+                                             "(Defaults to %(default)s.)",
+                     type=_check_negative,
+                     default="1")
+_PARSER.add_argument("-c", "--concurrency", help="How many messages may be "
+                                                 "sent at once with "
+                                                 "--split-newlines. Above "
+                                                 "1, messages may arrive "
+                                                 "out of order. (Defaults "
+                                                 "to %(default)s.)",
+                     type=_check_positive,
+                     default="1")
+_PARSER.add_argument("-v", "--verbose", help="Print the full traceback of "
+                                             "failed sends.",
+                     action="store_true")
 
 
 def parse_command_line():
-    def check_negative(argument):
-        value = int(argument)
-        if value < 0:
-            raise argparse.ArgumentTypeError("'%s' is not a positive integer"
-                                             % (argument,))
-        return value
-
-    parser = argparse.ArgumentParser(description="Redirects stdin to a "
-                                                 "Telegram channel or chat.")
-    parser.add_argument("token", help="API token of the Telegram bot.")
-    parser.add_argument("channel", help="Chat ID or channel for broadcasts.")
-    parser.add_argument("--type", help="Type of message to send. " +
-                                       "(Defaults to %(default)s.)",
-                        choices=MESSAGE_TYPES.keys(),
-                        default="text")
-    parser.add_argument("-m", "--parse-mode", help="How the input should be "
-                                                   "parsed.",
-                        choices=("HTML", "Markdown"))
-    parser.add_argument("-s", "--split-newlines", help="If specified, each "
-                                                       "input line will be "
-                                                       "sent as an individual "
-                                                       "message.",
-                        action="store_true")
-    parser.add_argument("-r", "--retries", help="How many times a failed send "
-                                                "should be retried. Specify "
-                                                "0 to retry indefinitely. "
-                                                "(Defaults to %(default)s.)",
-                        type=check_negative,
-                        default="1")
-
-    return parser.parse_args()
-
-
-async def send_message(bot, args, message, **kwargs):
-    retries = args.retries
+    return _PARSER.parse_args()
+
+
+async def send_message(bot, args, send, message, **kwargs):
+    global _resume_sending_at
+
+    loop = asyncio.get_event_loop()
+    channel = args.channel
+    retries_limit = args.retries
+    retries = retries_limit
+    attempt = 0
     while True:
+        await wait_until_sending_allowed(loop)
+
         try:
-            await MESSAGE_TYPES[args.type](bot,
-                                           args.channel,
-                                           message,
-                                           **kwargs)
-        except:
-            traceback.print_exc()
-
-            # Continue if the original value was 0
-            if args.retries == 0:
-                continue
-
-            # Abort if we tried as many times as we could
-            retries -= 1
-            if retries == 0:
-                raise RuntimeError("Message %r was not sent after %d retries"
-                                   % (message, args.retries))
+            await send(bot, channel, message, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The full traceback is only formatted when asked for
+            logger.warning("Failed to send message: %r", e,
+                           exc_info=logger.isEnabledFor(logging.DEBUG))
+
+            # Abort if we tried as many times as we could, unless the
+            # original value was 0
+            if retries_limit != 0:
+                retries -= 1
+                if retries == 0:
+                    raise RuntimeError("Message %r was not sent after %d "
+                                       "retries" % (message, retries_limit))
+
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                _resume_sending_at = max(_resume_sending_at,
+                                         loop.time() + retry_after)
+            else:
+                await asyncio.sleep(min(2 ** attempt, MAX_RETRY_DELAY))
+            attempt += 1
         else:
             break
 
 
-async def transfer_stdin(loop, args):
-    bot = telepot.aio.Bot(args.token, loop=loop)
+async def wait_until_sending_allowed(loop):
+    # Telegram asked us to back off, so hold every send until it's time. The
+    # deadline may be pushed back by another sender while we sleep.
+    while True:
+        delay = _resume_sending_at - loop.time()
+        if delay <= 0:
+            break
+        await asyncio.sleep(delay)
+
+
+def get_retry_after(error):
+    if not isinstance(error, telepot.exception.TelegramError):
+        return None
+    return error.json.get("parameters", {}).get("retry_after")
+
+
+async def transfer_stdin(loop, bot, args):
+    send = MESSAGE_TYPES[args.type]
+    parse_mode = args.parse_mode
+
+    # Large media coming down a pipe is uploaded as it is read, instead of
+    # being held in memory in its entirety first. aiohttp reads the stream in
+    # chunks on the default executor and closes it when done, hence the
+    # separate file object. A pipe can't be rewound though, so this is only
+    # possible when a single attempt was asked for.
+    if (args.type in STREAMED_TYPES and
+            args.retries == 1 and
+            not sys.stdin.buffer.seekable()):
+        with open(sys.stdin.fileno(), "rb", closefd=False) as stream:
+            await send_message(bot, args, send, stream)
+        return
 
     # If we are not dealing with text, read everything from stdin as binary,
     # and send away.
     if args.type != "text":
         data = sys.stdin.buffer.read()
-        await send_message(bot, args, data)
+        await send_message(bot, args, send, data)
         return
 
-    reader = Reader(loop, sys.stdin)
-
-    # If we don't need line-by-line output, go the easy way
+    # If we don't need line-by-line output, go the easy way. Nothing else
+    # runs while we wait for EOF, so there's no point in doing it off-loop.
+    # Telegram wants UTF-8 anyway, so decode it as such in a single pass, and
+    # don't let a stray invalid byte keep the rest of the input from being
+    # sent.
     if not args.split_newlines:
-        await send_message(bot,
-                           args,
-                           await reader.read(),
-                           parse_mode=args.parse_mode)
+        data = sys.stdin.buffer.read().decode("utf-8", errors="replace")
+        await send_message(bot, args, send, data, parse_mode=parse_mode)
         return
 
     # Go the hard way
-    async for line in reader:
-        await send_message(bot, args, line, parse_mode=args.parse_mode)
+    await transfer_lines(loop, bot, args, send)
+
+
+async def transfer_lines(loop, bot, args, send):
+    # Lines that arrive while a send is in flight are coalesced into a single
+    # message, so bursty input doesn't pay a full round-trip per line. Marked
+    # up lines are left alone though, or a single line with broken markup
+    # would take the whole batch down with it.
+    queue = asyncio.Queue(MAX_QUEUED_LINES)
+
+    async def produce(reader):
+        # The consumer has to wake up even if reading fails, to learn about it
+        try:
+            async for line in reader:
+                await queue.put(line)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    with closing(open_line_reader(loop, sys.stdin)) as reader:
+        producer = loop.create_task(produce(reader))
+        messages = batch_lines(queue, coalesce=args.parse_mode is None)
+        try:
+            await send_messages(loop, bot, args, send, messages)
+
+            # Surface any error that cut the input short
+            await producer
+        finally:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            await messages.aclose()
+
+
+async def send_messages(loop, bot, args, send, messages):
+    # Up to args.concurrency messages are sent at once
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def send_one(message):
+        try:
+            await send_message(bot,
+                               args,
+                               send,
+                               message,
+                               parse_mode=args.parse_mode)
+        finally:
+            slots.release()
+
+    sends = set()
+    next_message = None
+    try:
+        while True:
+            # Only collect the next message once it can be sent right away,
+            # so that lines keep piling up into it in the meantime
+            await slots.acquire()
+
+            # Wait for input and for the sends in flight at the same time, so
+            # that a failed send stops us without waiting for more input to
+            # arrive.
+            next_message = loop.create_task(receive(messages))
+            while not next_message.done():
+                done, _ = await asyncio.wait(
+                    sends | {next_message},
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in done - {next_message}:
+                    sends.remove(task)
+                    task.result()
+
+            message = next_message.result()
+            if message is None:
+                break
+
+            sends.add(loop.create_task(send_one(message)))
+
+        await asyncio.gather(*sends)
+    finally:
+        # Don't leave anything running behind us if we're bailing out
+        pending = list(sends)
+        if next_message is not None:
+            pending.append(next_message)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def receive(messages):
+    try:
+        return await messages.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def batch_lines(queue, coalesce=True):
+    pending = None
+    while True:
+        line = pending if pending is not None else await queue.get()
+        pending = None
+        if line is None:
+            return
+
+        if not coalesce:
+            yield line
+            continue
+
+        buffer = line
+
+        # A single oversized line is split into as many messages as needed
+        while len(buffer) > MAX_MESSAGE_LENGTH:
+            yield buffer[:MAX_MESSAGE_LENGTH]
+            buffer = buffer[MAX_MESSAGE_LENGTH:]
+
+        # Take whatever else is already queued, as long as it fits
+        while not queue.empty():
+            line = queue.get_nowait()
+            if line is None:
+                yield buffer
+                return
+
+            if len(buffer) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+                pending = line
+                break
+            buffer += "\n" + line
+
+        yield buffer
+
+
+def start_logging(verbose):
+    # Our records are written out on the listener's thread, so that a slow
+    # stderr never holds up the event loop. Everyone else's are left to the
+    # default handling.
+    records = SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(name)s: %(message)s"))
+    listener = QueueListener(records, handler)
+
+    queue_handler = QueueHandler(records)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+    listener.start()
+    return listener, queue_handler
+
+
+def stop_logging(listener, queue_handler):
+    # Nothing would be left to write out records queued after this
+    logger.removeHandler(queue_handler)
+    logger.propagate = True
+    listener.stop()
 
 
 def main():
     args = parse_command_line()
 
-    with closing(asyncio.get_event_loop()) as loop:
-        loop.run_until_complete(transfer_stdin(loop, args))
+    listener, queue_handler = start_logging(args.verbose)
+    try:
+        with closing(asyncio.get_event_loop()) as loop:
+            bot = telepot.aio.Bot(args.token, loop=loop)
+            loop.run_until_complete(transfer_stdin(loop, bot, args))
+    finally:
+        stop_logging(listener, queue_handler)
 
 
 if __name__ == "__main__":